@@ -1,19 +1,45 @@
 import requests
+from requests.adapters import HTTPAdapter
 import argparse
-import xml.etree.ElementTree as ET
+from lxml import etree as ET
 import csv
 import sys
+import threading
 from datetime import datetime
 import logging
 import os
 import json
-import queue
+from collections import deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import lru_cache
 
 FILENAME = "extract-" + datetime.now().strftime("%m-%d-%Y-%H-%M-%S")
 REQUEST_URL = os.environ.get('DBGAP_STUDY_ENDPOINT', 'https://www.ncbi.nlm.nih.gov/projects/gap/cgi-bin/GetSampleStatus.cgi?study_id={}&rettype=xml')
 LOG_FILE = FILENAME + ".log"
+# Maximum number of study XMLs requested from dbGaP at the same time
+MAX_CONCURRENT_REQUESTS = 16
+REQUEST_TIMEOUT_SECONDS = 30
+# Size of the response chunks fed to the XML parser while a study downloads
+STREAM_CHUNK_SIZE = 64 * 1024
+# Number of earlier versions requested at once when a study lacks samples
+FALLBACK_VERSIONS_TO_PROBE = 2
+OUTPUT_BUFFER_SIZE = 1024 * 1024
 logging.basicConfig(filename=LOG_FILE, level=logging.DEBUG)
 
+# Every request goes to the same dbGaP host, so share one session to reuse
+# connections (and their TLS handshakes) across studies and worker threads
+SESSION = requests.Session()
+# Sample status XML compresses very well, so always ask for gzip
+SESSION.headers["Accept-Encoding"] = "gzip"
+SESSION.mount(
+    "https://",
+    HTTPAdapter(pool_connections=1, pool_maxsize=MAX_CONCURRENT_REQUESTS),
+)
+SESSION.mount(
+    "http://",
+    HTTPAdapter(pool_connections=1, pool_maxsize=MAX_CONCURRENT_REQUESTS),
+)
+
 FIELD_NAMES = [
     "submitted_sample_id",
     "biosample_id",
@@ -35,6 +61,32 @@ FIELD_NAMES = [
     "study_with_consent",
     "study_subject_id",
 ]
+# Position of each field in an output row
+FIELD_INDEX = {field: index for index, field in enumerate(FIELD_NAMES)}
+# Sample attributes drawn from a small vocabulary. Their values are interned
+# so the rows held for a study share one string per distinct value.
+INTERNED_FIELD_INDEXES = {
+    FIELD_INDEX[field]
+    for field in [
+        "consent_code",
+        "consent_short_name",
+        "sex",
+        "body_site",
+        "analyte_type",
+        "repository",
+        "dbgap_status",
+    ]
+}
+
+# A study accession along with the parts of it used in each sample's row
+StudyAccessionParts = namedtuple(
+    "StudyAccessionParts",
+    ["study_accession", "study_prefix", "study_accession_w_version"],
+)
+
+# Compiled once here rather than re-evaluating the paths for every sample
+USES_XPATH = ET.XPath("Uses/Use")
+STATS_XPATH = ET.XPath("SRAData/Stats")
 
 
 def main():
@@ -90,10 +142,8 @@ def main():
         studies_to_scrape = args.study_accession_list
 
     if args.study_accession_list_filename is not None:
-        f = open(args.study_accession_list_filename)
-        studies_to_scrape = f.readlines()
-        studies_to_scrape = list(map(lambda x: x.strip(), studies_to_scrape))
-        f.close()
+        with open(args.study_accession_list_filename) as f:
+            studies_to_scrape = [line.strip() for line in f if line.strip()]
 
     logging.debug(
         "Extracting the below studies to {} \n".format(output_filename)
@@ -134,6 +184,7 @@ def setup_logging(log_filename):
     logging.getLogger("urllib3").setLevel(logging.WARNING)
 
 
+@lru_cache(maxsize=None)
 def _get_previous_version_of_study_accession(study_accession):
     """
     Get the previous version of a given study accession by attemping to walk backwards
@@ -159,29 +210,78 @@ def _get_previous_version_of_study_accession(study_accession):
     return previous_version_of_study_accession
 
 
+def _get_previous_versions_of_study_accession(study_accession, count):
+    """
+    Get up to `count` previous versions of a given study accession, newest first
+
+    Args:
+        study_accession (str): current study accession number / phsid
+        count (int): maximum number of previous versions to return
+
+    Returns:
+        List[str]: previous versions of study accession number
+    """
+    previous_versions = []
+    previous_version = _get_previous_version_of_study_accession(study_accession)
+    while previous_version and len(previous_versions) < count:
+        previous_versions.append(previous_version)
+        previous_version = _get_previous_version_of_study_accession(previous_version)
+    return previous_versions
+
+
+def _iter_study_xml_events(study_accession, stop_downloads=None):
+    """
+    Stream the sample status XML for a study from dbGaP into an incremental
+    parser, yielding Study and Sample elements while the download is still
+    in progress
+
+    Args:
+        study_accession (str): the study phsid/accession number
+        stop_downloads (threading.Event): when set, the download is abandoned
+            at the next chunk
+
+    Yields:
+        (str, lxml.etree._Element): "start" or "end" event and its element
+    """
+    parser = ET.XMLPullParser(events=("start", "end"), tag=("Study", "Sample"))
+    with SESSION.get(
+        REQUEST_URL.format(study_accession),
+        stream=True,
+        timeout=REQUEST_TIMEOUT_SECONDS,
+    ) as r:
+        logging.debug(
+            "Fetching %s (Content-Encoding: %s)",
+            study_accession,
+            r.headers.get("Content-Encoding", "none"),
+        )
+        # Feed raw bytes and let the parser take the encoding from the XML
+        # prolog; decoding to str first would only be re-encoded by libxml2
+        for chunk in r.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+            if stop_downloads is not None and stop_downloads.is_set():
+                raise RuntimeError(
+                    "Download of {} was stopped".format(study_accession)
+                )
+            parser.feed(chunk)
+            yield from parser.read_events()
+    parser.close()
+    yield from parser.read_events()
+
+
 def _get_flattened_sra_data_details_from_xml_sample(sample):
     """
     Get SRA details as a string similar to how it's represented on
     the dbGaP site
 
     Args:
-        sample (xml.etree.ElementTree.Element): sample element from XML tree
+        sample (lxml.etree._Element): sample element from XML tree
 
     Returns:
         str: SRA details as a string
     """
-    sra_datas = sample.findall("SRAData")[0].findall("Stats")
-    sra_data_details = ""
-    if len(sra_datas) > 0:
-        for stat in sra_datas:
-            stat_dict = stat.attrib
-            stats_as_string = ""
-            for key in sorted(stat_dict):
-                stats_as_string += key + ":" + stat_dict[key] + "|"
-            if stats_as_string[-1] == "|":
-                stats_as_string = stats_as_string[:-1]
-            sra_data_details += "(" + stats_as_string + ") "
-    return sra_data_details
+    return "".join(
+        "(" + "|".join(key + ":" + value for key, value in sorted(stat.items())) + ") "
+        for stat in STATS_XPATH(sample)
+    )
 
 
 def _get_sra_data_details_from_xml_sample(sample):
@@ -189,99 +289,383 @@ def _get_sra_data_details_from_xml_sample(sample):
     Get SRA details as a dictionary
 
     Args:
-        sample (xml.etree.ElementTree.Element): sample element from XML tree
+        sample (lxml.etree._Element): sample element from XML tree
 
     Returns:
-        dict: SRA details as a dict
+        str: SRA details as a JSON-encoded dict
     """
-    sra_datas = sample.findall("SRAData")[0].findall("Stats")
     sra_data_details = {}
-    if len(sra_datas) > 0:
-        for stat in sra_datas:
-            stat_dict = stat.attrib
-            sra_data_details.update(stat_dict)
-    sra_details = json.dumps(sra_data_details).replace('""', '"')
-    return sra_details
+    for stat in STATS_XPATH(sample):
+        sra_data_details.update(stat.attrib)
+    return json.dumps(sra_data_details)
 
 
-def get_sample_dict_from_xml_sample(study_accession, sample, args):
+def _get_sra_data_details_function(args):
     """
-    Get dictionary of sample from the XML sample
+    Get the function that renders SRA details for a sample, as selected by
+    --expand_sra_details, so the choice is made once rather than per sample
+
+    Args:
+        args (argparse.Namespace): arguments sent to command line
+
+    Returns:
+        function: takes a sample element and returns its SRA details as a str
+    """
+    if args.expand_sra_details:
+        return _get_sra_data_details_from_xml_sample
+    return _get_flattened_sra_data_details_from_xml_sample
+
+
+def _get_study_accession_parts(study_accession):
+    """
+    Get the parts of a study accession that the per-sample study columns are
+    built from, e.g. "phs001234" and "phs001234.v3" for "phs001234.v3.p1"
 
     Args:
         study_accession (str): the study phsid/accession number
-        sample (xml.etree.ElementTree.Element): sample element from XML tree
+
+    Returns:
+        StudyAccessionParts: the study accession, the study phsid and the
+            study phsid with version
+    """
+    study_accession_split = study_accession.split(".")
+    return StudyAccessionParts(
+        study_accession=study_accession,
+        study_prefix=".".join(study_accession_split[:-2]),
+        study_accession_w_version=".".join(study_accession_split[:-1]),
+    )
+
+
+def get_sample_dict_from_xml_sample(study, sample, args):
+    """
+    Get dictionary of sample from the XML sample
+
+    Args:
+        study (StudyAccessionParts): the study phsid/accession number and its
+            parts, see _get_study_accession_parts
+        sample (lxml.etree._Element): sample element from XML tree
         args (argparse.Namespace): arguments sent to command line
 
     Returns:
-        dict: SRA details as a dict
+        dict: the sample's output values keyed by FIELD_NAMES
     """
-    sample_dict = sample.attrib
+    return dict(
+        zip(
+            FIELD_NAMES,
+            get_sample_row_from_xml_sample(
+                study, sample, _get_sra_data_details_function(args)
+            ),
+        )
+    )
 
-    sample_dict["sample_use"] = json.dumps(
-        [use.text for use in sample.findall("Uses")[0].findall("Use")]
+
+def get_sample_row_from_xml_sample(study, sample, get_sra_data_details):
+    """
+    Get the output row for the XML sample, with values in FIELD_NAMES order.
+    The row is filled in by position rather than going through a dict per
+    sample.
+
+    Args:
+        study (StudyAccessionParts): the study phsid/accession number and its
+            parts, see _get_study_accession_parts
+        sample (lxml.etree._Element): sample element from XML tree
+        get_sra_data_details (function): renders the sample's SRA details,
+            see _get_sra_data_details_function
+
+    Returns:
+        List[str]: row for the sample
+    """
+    row = [""] * len(FIELD_NAMES)
+    for field, value in sample.attrib.items():
+        index = FIELD_INDEX.get(field)
+        if index in INTERNED_FIELD_INDEXES:
+            row[index] = sys.intern(value)
+        elif index is not None:
+            row[index] = value
+
+    row[FIELD_INDEX["sample_use"]] = json.dumps(
+        [use.text for use in USES_XPATH(sample)]
     )
 
-    if args.expand_sra_details:
-        sample_dict["sra_data_details"] = _get_sra_data_details_from_xml_sample(sample)
+    row[FIELD_INDEX["sra_data_details"]] = get_sra_data_details(sample)
+
+    row[FIELD_INDEX["study_accession"]] = study.study_accession
+    consent_code = sample.get("consent_code")
+    if consent_code is not None:
+        row[FIELD_INDEX["study_accession_with_consent"]] = (
+            study.study_accession + ".c" + consent_code
+        )
+        row[FIELD_INDEX["study_with_consent"]] = (
+            study.study_prefix + ".c" + consent_code
+        )
     else:
-        sample_dict[
-            "sra_data_details"
-        ] = _get_flattened_sra_data_details_from_xml_sample(sample)
-
-    sample_dict["study_accession"] = study_accession
-    if "consent_code" in sample_dict:
-        sample_dict["study_accession_with_consent"] = (
-            study_accession + ".c" + sample_dict.get("consent_code", "")
+        logging.debug(
+            "Sample %s lacks a consent code. Leaving "
+            "study_accession_with_consent and study_with_consent columns empty.",
+            sample.get("submitted_sample_id", ""),
         )
-        sample_dict["study_with_consent"] = (
-            ".".join(study_accession.split(".")[:-2])
-            + ".c"
-            + sample_dict.get("consent_code", "")
+    submitted_subject_id = sample.get("submitted_subject_id")
+    if submitted_subject_id is not None:
+        row[FIELD_INDEX["study_subject_id"]] = (
+            study.study_accession_w_version + "_" + submitted_subject_id
         )
     else:
         logging.debug(
-            "Sample "
-            + sample.attrib.get("submitted_sample_id", "")
-            + " lacks a consent code. Leaving "
-            + "study_accession_with_consent and study_with_consent columns empty."
+            "Sample %s lacks a submitted subject id. Leaving "
+            "study_subject_id column empty.",
+            sample.get("submitted_sample_id", ""),
         )
-    study_accession_w_version = ".".join(sample_dict["study_accession"].split(".")[:-1])
-    sample_dict["study_subject_id"] = (
-        study_accession_w_version + "_" + sample_dict["submitted_subject_id"]
-    )
-    return sample_dict
+    return row
 
 
-def write_sample_rows_for_study(
-    study_accession, sample_elements, output_filename, args
-):
+def get_sample_rows_for_study(study_accession, args, stop_downloads=None):
     """
-    Write rows to the output file for the samples provided.
+    Fetch a study from dbGaP and build a row for each of its samples as the
+    XML streams in.
 
     Args:
-        study_accession (str): the study phsid/accession number
-        sample (xml.etree.ElementTree.Element): sample element from XML tree
-        output_filename (str): output file name to write to
+        study_accession (str): the study phsid/accession number to request
         args (argparse.Namespace): arguments sent to command line
+        stop_downloads (threading.Event): when set, the download is abandoned
+            at the next chunk
+
+    Returns:
+        (str, List[List[str]]): the study accession dbGaP responded with and
+            a row per sample
     """
-    sample_rows_to_write_for_this_study = []
-    for sample in sample_elements:
-        try:
-            row = []
-            sample_dict = get_sample_dict_from_xml_sample(study_accession, sample, args)
+    get_sra_data_details = _get_sra_data_details_function(args)
+    study = None
+    sample_rows = []
+    for event, element in _iter_study_xml_events(study_accession, stop_downloads):
+        if event == "start":
+            if element.tag == "Study" and study is None:
+                # The accession's parts only depend on the study, so work
+                # them out once rather than for every sample
+                study = _get_study_accession_parts(element.get("accession"))
+        elif element.tag == "Sample":
+            if study is None:
+                raise ValueError(
+                    "Sample found before Study in response for {}".format(
+                        study_accession
+                    )
+                )
+            try:
+                sample_rows.append(
+                    get_sample_row_from_xml_sample(
+                        study, element, get_sra_data_details
+                    )
+                )
+            except Exception as e:
+                logging.error(
+                    "Failed to build row for sample %s of study %s. %s",
+                    element.get("submitted_sample_id", ""),
+                    study.study_accession,
+                    e,
+                )
+                raise
+            # clear() empties the sample but leaves it attached to SampleList;
+            # also drop the samples already handled so that only the current
+            # one is held in memory, however large the study
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+    if study is None:
+        raise ValueError("No Study found in response for {}".format(study_accession))
+    return study.study_accession, sample_rows
+
+
+def _pick_probe_result(probe_group, probe_results):
+    """
+    Pick the result to use for a study from the versions requested for it:
+    the newest version with samples, as soon as every newer version has come
+    back empty. Responses for older versions are not needed by then, so they
+    may still be outstanding (or have failed).
+
+    Args:
+        probe_group (List[str]): study accessions requested for the study,
+            newest first
+        probe_results (dict): completed futures of get_sample_rows_for_study
+            keyed by the study accession requested
+
+    Returns:
+        (str, List[List[str]]): the newest result with samples, the oldest
+            version's result if none has samples, or None while a version
+            that could still be picked is outstanding
+    """
+    for study_accession in probe_group:
+        future = probe_results.get(study_accession)
+        if future is None:
+            return None
+        result = future.result()
+        if len(result[1]) > 0:
+            return result
+    return result
 
-            for field in FIELD_NAMES:
-                row.append(sample_dict.get(field, ""))
 
-            sample_rows_to_write_for_this_study.append(row)
-        except Exception as e:
-            logging.error(
-                "Error processing sample "
-                + sample.attrib.get("submitted_sample_id", "")
+def _get_versions_to_probe(study_accession, requested):
+    """
+    Get the previous versions to request for a study accession that lacks
+    samples, stopping at the first version that was already requested
+
+    Args:
+        study_accession (str): study phsid/accession number lacking samples
+        requested (set): study accessions already requested
+
+    Returns:
+        List[str]: previous versions of study accession number, newest first
+    """
+    previous_versions = _get_previous_versions_of_study_accession(
+        study_accession, FALLBACK_VERSIONS_TO_PROBE
+    )
+    versions_to_probe = []
+    for previous_version in previous_versions:
+        if previous_version in requested:
+            break
+        versions_to_probe.append(previous_version)
+
+    if versions_to_probe:
+        logging.error(
+            "\nERROR: Study accession {} lacks samples. Going back to {}.".format(
+                study_accession, ", ".join(versions_to_probe)
+            )
+        )
+    elif previous_versions:
+        logging.debug(
+            "\nStudy accession {} lacks samples. Previous version {} was already requested.".format(
+                study_accession, previous_versions[0]
+            )
+        )
+    else:
+        logging.debug(
+            "\nCould not find samples for any version of study accession {}.".format(
+                study_accession
             )
-            logging.error(e)
-    write_list_of_rows_to_tsv(sample_rows_to_write_for_this_study, output_filename)
+        )
+    return versions_to_probe
+
+
+def _iter_sample_rows_for_studies(studies_to_scrape, args):
+    """
+    Fetch the given studies concurrently, going back to previous versions of
+    any study that lacks samples, and yield each study's rows in the order of
+    the input list
+
+    Args:
+        studies_to_scrape (List[str]): the list of study phsid/accession numbers
+        args (argparse.Namespace): arguments sent to command line
+
+    Yields:
+        (str, List[List[str]]): the study accession dbGaP responded with and
+            a row per sample, for each input study with samples in some version
+    """
+    # Use a queue to make it appropriate to modify the list during iteration.
+    # Only this thread touches it, so a plain deque needs no locking.
+    # Each entry is (slot, study_accession): the slot is the position of the
+    # input study it is requested for, and previous versions requested for a
+    # study lacking samples share that study's slot
+    q = deque()
+    # Study accessions that have been queued, so none is requested twice
+    requested = set()
+    # Versions currently requested for each slot, newest first, or None once
+    # the slot's result has been picked
+    probe_groups = []
+    for study_accession in studies_to_scrape:
+        if study_accession not in requested:
+            requested.add(study_accession)
+            q.append((len(probe_groups), study_accession))
+            probe_groups.append([study_accession])
+    # Completed futures for the versions in each slot's probe group
+    probe_results = [{} for _ in probe_groups]
+
+    # Studies finish downloading in any order; each slot's result is held in
+    # `finished` until every earlier slot has been yielded. Only slots less
+    # than MAX_CONCURRENT_REQUESTS past next_slot are requested, so at most
+    # that many studies' rows are held in memory while a slow study (or one
+    # going back to previous versions) holds up the output.
+    finished = {}
+    next_slot = 0
+    # Requests that have been submitted, mapped to their (slot, accession)
+    in_flight = {}
+    # Set when the scrape stops early, so the downloads still running in the
+    # pool give up instead of holding up the exit
+    stop_downloads = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS)
+    try:
+        while q or in_flight:
+            # Keep up to MAX_CONCURRENT_REQUESTS studies in flight, so a previous
+            # version is requested as soon as a study turns out to lack samples
+            while (
+                q
+                and len(in_flight) < MAX_CONCURRENT_REQUESTS
+                and q[0][0] < next_slot + MAX_CONCURRENT_REQUESTS
+            ):
+                slot, study_accession = q.popleft()
+                if probe_groups[slot] is None:
+                    continue
+                future = executor.submit(
+                    get_sample_rows_for_study, study_accession, args, stop_downloads
+                )
+                in_flight[future] = (slot, study_accession)
+            if not in_flight:
+                continue
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                slot, requested_accession = in_flight.pop(future)
+                if probe_groups[slot] is None:
+                    # A newer version has already been picked for this study,
+                    # so this response (or its failure) is not needed
+                    continue
+                probe_results[slot][requested_accession] = future
+                try:
+                    result = _pick_probe_result(
+                        probe_groups[slot], probe_results[slot]
+                    )
+                except Exception as e:
+                    logging.error(
+                        "Failed to parse data from NIH endpoint. {}".format(e)
+                    )
+                    exit(1)
+                if result is None:
+                    continue
+
+                study_accession, sample_rows = result
+                if len(sample_rows) == 0:
+                    versions_to_probe = _get_versions_to_probe(
+                        study_accession, requested
+                    )
+                    if versions_to_probe:
+                        requested.update(versions_to_probe)
+                        probe_groups[slot] = versions_to_probe
+                        probe_results[slot] = {}
+                        # Request them next, ahead of the input studies
+                        # still queued
+                        q.extendleft(
+                            (slot, version) for version in reversed(versions_to_probe)
+                        )
+                        continue
+                    result = None
+
+                probe_groups[slot] = None
+                probe_results[slot] = None
+                for other_future, (other_slot, _) in in_flight.items():
+                    if other_slot == slot:
+                        other_future.cancel()
+                finished[slot] = result
+
+            while next_slot in finished:
+                result = finished.pop(next_slot)
+                next_slot += 1
+                if result is not None:
+                    yield result
+    finally:
+        # Nothing is left in flight after a complete scrape. After a failure,
+        # don't wait for the remaining downloads to finish.
+        stop_downloads.set()
+        for future in in_flight:
+            future.cancel()
+        executor.shutdown(wait=False)
 
 
 def scrape(studies_to_scrape, output_filename, args):
@@ -294,68 +678,42 @@ def scrape(studies_to_scrape, output_filename, args):
         output_filename (str): output file name to write to
         args (argparse.Namespace): arguments sent to command line
     """
-    study_data = {}
-
-    if os.path.exists(output_filename):
-        os.remove(output_filename)
-
-    write_list_of_rows_to_tsv([FIELD_NAMES], output_filename)
-
-    # Use a queue to make it appropriate to modify the list during iteration
-    q = queue.Queue()
-    [q.put(s) for s in studies_to_scrape]
-    already_seen = []
+    already_seen = set()
+
+    # Keep the output file and its writer open for the whole scrape rather than
+    # reopening it for every study. Text mode with an explicit buffer size
+    # gives a single 1 MiB BufferedWriter under the TextIOWrapper.
+    with open(
+        output_filename,
+        "w",
+        encoding="utf-8",
+        newline="",
+        buffering=OUTPUT_BUFFER_SIZE,
+    ) as out_file:
+        # sample_use (and expanded sra_data_details) hold JSON, so fields need
+        # csv's quoting rather than a plain "\t".join
+        tsv_writer = csv.writer(out_file, delimiter="\t")
+        write_list_of_rows_to_tsv([FIELD_NAMES], tsv_writer)
 
-    while not q.empty():
-        study_accession = q.get_nowait()
-        request_url = REQUEST_URL.format(study_accession)
-        try:
-            r = requests.get(request_url)
-            root = ET.fromstring(r.text)
-        except Exception as e:
-            logging.error("Failed to parse data from NIH endpoint. {}".format(e))
-            exit(1)
+        # Rows are only ever written from this thread, so the writer needs no
+        # locking
+        for study_accession, sample_rows in _iter_sample_rows_for_studies(
+            studies_to_scrape, args
+        ):
+            if study_accession not in already_seen:
+                write_list_of_rows_to_tsv(sample_rows, tsv_writer)
+                already_seen.add(study_accession)
 
-        study_accession = root.findall("Study")[0].attrib["accession"]
-        sample_list_element = root.findall("Study")[0].findall("SampleList")[0]
-        sample_elements = sample_list_element.findall("Sample")
 
-        if len(sample_elements) == 0:
-            previous_version_of_study_accession = _get_previous_version_of_study_accession(
-                study_accession
-            )
-            if previous_version_of_study_accession:
-                q.put_nowait(previous_version_of_study_accession)
-                logging.error(
-                    "\nERROR: Study accession {} lacks samples. Going back a version to {}.".format(
-                        study_accession, previous_version_of_study_accession
-                    )
-                )
-            else:
-                logging.debug(
-                    "\nCould not find samples for any version of study accession {}.".format(
-                        study_accession
-                    )
-                )
-        elif study_accession not in already_seen:
-            write_sample_rows_for_study(
-                study_accession, sample_elements, output_filename, args
-            )
-            already_seen.append(study_accession)
-
-
-def write_list_of_rows_to_tsv(rows, output_filename):
+def write_list_of_rows_to_tsv(rows, tsv_writer):
     """
     Write the given rows to the output file.
 
     Args:
         rows (List[str]): list of rows to write to file
-        output_filename (str): output file name to write to
+        tsv_writer (csv.writer): writer for the open output file
     """
-    with open(output_filename, "a+") as out_file:
-        tsv_writer = csv.writer(out_file, delimiter="\t")
-        for row in rows:
-            tsv_writer.writerow(row)
+    tsv_writer.writerows(rows)
 
 
 if __name__ == "__main__":
@@ -2,12 +2,23 @@
 # python3 -m pytest tests.py
 
 import sys
+import csv
+import io
 import pytest
 import json
 import filecmp
 import dbgap_extract
+import validate_extract
 import argparse
-import xml.etree.ElementTree as ET
+import threading
+from concurrent.futures import Future
+from lxml import etree as ET
+
+STUDY = dbgap_extract.StudyAccessionParts(
+    study_accession="phs001234.v3.p1",
+    study_prefix="phs001234",
+    study_accession_w_version="phs001234.v3",
+)
 
 
 def test_get_previous_version_of_study_accession():
@@ -31,19 +42,34 @@ def test_get_previous_version_of_study_accession():
     assert previous_version == "phs000179.v32.p2"
 
 
-def get_test_sample_elements():
-    with open("test_data/test_xml.xml") as fh:
-        xml_text = fh.read()
-        root = ET.fromstring(xml_text)
-        study_accession = root.findall("Study")[0].attrib["accession"]
-        sample_list_element = root.findall("Study")[0].findall("SampleList")[0]
-        sample_elements = sample_list_element.findall("Sample")
-        return sample_elements
+def test_get_previous_versions_of_study_accession():
+    previous_versions = dbgap_extract._get_previous_versions_of_study_accession(
+        "phs001143.v4.p1", 2
+    )
+    assert previous_versions == ["phs001143.v3.p1", "phs001143.v2.p1"]
+
+    # Stops at the first version
+    previous_versions = dbgap_extract._get_previous_versions_of_study_accession(
+        "phs001143.v2.p1", 2
+    )
+    assert previous_versions == ["phs001143.v1.p1"]
+
+    previous_versions = dbgap_extract._get_previous_versions_of_study_accession(
+        "phs001143.v1.p1", 2
+    )
+    assert previous_versions == []
+
 
+@pytest.fixture(scope="session")
+def sample_elements():
+    # Parsed once and shared by every test; tests must not modify the elements
+    root = ET.parse("test_data/test_xml.xml").getroot()
+    sample_list_element = root.findall("Study")[0].findall("SampleList")[0]
+    sample_elements = sample_list_element.findall("Sample")
+    return sample_elements
 
-def test_get_sra_data_details_from_xml_sample():
-    sample_elements = get_test_sample_elements()
 
+def test_get_sra_data_details_from_xml_sample(sample_elements):
     sra_data_details = dbgap_extract._get_flattened_sra_data_details_from_xml_sample(
         sample_elements[0]
     )
@@ -61,14 +87,36 @@ def test_get_sra_data_details_from_xml_sample():
     )
 
 
-def assert_dict_equality(dict_a, dict_b):
-    assert len(list(dict_a.keys())) == len(list(dict_b.keys()))
-    for key in dict_a:
-        assert dict_a[key] == dict_b[key]
+def test_get_sra_data_details_with_empty_value_from_xml_sample():
+    sample = ET.fromstring(
+        '<Sample><SRAData><Stats status="public" center=""/></SRAData></Sample>'
+    )
+    sra_data_details = dbgap_extract._get_sra_data_details_from_xml_sample(sample)
+    assert json.loads(sra_data_details) == {"status": "public", "center": ""}
+
+
+def test_get_sra_data_details_function():
+    args = argparse.Namespace(expand_sra_details=False)
+    assert (
+        dbgap_extract._get_sra_data_details_function(args)
+        is dbgap_extract._get_flattened_sra_data_details_from_xml_sample
+    )
+
+    args = argparse.Namespace(expand_sra_details=True)
+    assert (
+        dbgap_extract._get_sra_data_details_function(args)
+        is dbgap_extract._get_sra_data_details_from_xml_sample
+    )
+
+
+def test_get_study_accession_parts():
+    study = dbgap_extract._get_study_accession_parts("phs001234.v3.p1")
+    assert study.study_accession == "phs001234.v3.p1"
+    assert study.study_prefix == "phs001234"
+    assert study.study_accession_w_version == "phs001234.v3"
 
 
-def test_get_sample_dict_from_xml_sample():
-    sample_elements = get_test_sample_elements()
+def test_get_sample_dict_from_xml_sample(sample_elements):
     args = argparse.Namespace(expand_sra_details=False)
 
     expected_sample_dict = {
@@ -93,10 +141,10 @@ def test_get_sample_dict_from_xml_sample():
         "study_subject_id": "phs001234.v3_ABC",
     }
     sample_dict = dbgap_extract.get_sample_dict_from_xml_sample(
-        "phs001234.v3.p1", sample_elements[0], args
+        STUDY, sample_elements[0], args
     )
     sample_dict["sample_use"] = json.loads(sample_dict["sample_use"])
-    assert_dict_equality(sample_dict, expected_sample_dict)
+    assert sample_dict == expected_sample_dict
 
     expected_sample_dict = {
         "repository": "FGH",
@@ -120,14 +168,13 @@ def test_get_sample_dict_from_xml_sample():
         "study_subject_id": "phs001234.v3_CDE",
     }
     sample_dict = dbgap_extract.get_sample_dict_from_xml_sample(
-        "phs001234.v3.p1", sample_elements[1], args
+        STUDY, sample_elements[1], args
     )
     sample_dict["sample_use"] = json.loads(sample_dict["sample_use"])
-    assert_dict_equality(sample_dict, expected_sample_dict)
+    assert sample_dict == expected_sample_dict
 
 
-def test_get_sample_dict_sra_expand_from_xml_sample():
-    sample_elements = get_test_sample_elements()
+def test_get_sample_dict_sra_expand_from_xml_sample(sample_elements):
     args = argparse.Namespace(expand_sra_details=True)
 
     expected_sample_dict = {
@@ -161,11 +208,11 @@ def test_get_sample_dict_sra_expand_from_xml_sample():
         "study_subject_id": "phs001234.v3_ABC",
     }
     sample_dict = dbgap_extract.get_sample_dict_from_xml_sample(
-        "phs001234.v3.p1", sample_elements[0], args
+        STUDY, sample_elements[0], args
     )
     sample_dict["sample_use"] = json.loads(sample_dict["sample_use"])
     sample_dict["sra_data_details"] = json.loads(sample_dict["sra_data_details"])
-    assert_dict_equality(sample_dict, expected_sample_dict)
+    assert sample_dict == expected_sample_dict
 
     expected_sample_dict = {
         "repository": "FGH",
@@ -198,8 +245,464 @@ def test_get_sample_dict_sra_expand_from_xml_sample():
         "study_subject_id": "phs001234.v3_CDE",
     }
     sample_dict = dbgap_extract.get_sample_dict_from_xml_sample(
-        "phs001234.v3.p1", sample_elements[1], args
+        STUDY, sample_elements[1], args
     )
     sample_dict["sample_use"] = json.loads(sample_dict["sample_use"])
     sample_dict["sra_data_details"] = json.loads(sample_dict["sra_data_details"])
-    assert_dict_equality(sample_dict, expected_sample_dict)
+    assert sample_dict == expected_sample_dict
+
+
+def test_get_sample_row_from_xml_sample(sample_elements):
+    row = dbgap_extract.get_sample_row_from_xml_sample(
+        STUDY,
+        sample_elements[0],
+        dbgap_extract._get_flattened_sra_data_details_from_xml_sample,
+    )
+    assert len(row) == len(dbgap_extract.FIELD_NAMES)
+    assert row[0] == "NWD1"
+    assert row[dbgap_extract.FIELD_INDEX["sex"]] == "male"
+    assert row[-4:] == [
+        "phs001234.v3.p1",
+        "phs001234.v3.p1.c1",
+        "phs001234.c1",
+        "phs001234.v3_ABC",
+    ]
+
+
+def test_get_sample_row_with_missing_elements_from_xml_sample():
+    # A sample without Uses, SRAData, consent code or subject id still gets a
+    # row, with those columns left empty
+    sample = ET.fromstring('<Sample submitted_sample_id="NWD3" sex="female"/>')
+
+    row = dbgap_extract.get_sample_row_from_xml_sample(
+        STUDY,
+        sample,
+        dbgap_extract._get_flattened_sra_data_details_from_xml_sample,
+    )
+    sample_dict = dict(zip(dbgap_extract.FIELD_NAMES, row))
+    assert sample_dict["submitted_sample_id"] == "NWD3"
+    assert sample_dict["sex"] == "female"
+    assert sample_dict["sample_use"] == "[]"
+    assert sample_dict["sra_data_details"] == ""
+    assert sample_dict["study_accession"] == "phs001234.v3.p1"
+    assert sample_dict["study_with_consent"] == ""
+    assert sample_dict["study_subject_id"] == ""
+
+
+class _StreamedResponse:
+    """Stand-in for a streamed requests response serving `content` in chunks"""
+
+    def __init__(self, content, chunk_size):
+        self.content = content
+        self.chunk_size = chunk_size
+        self.headers = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def iter_content(self, chunk_size=1):
+        for start in range(0, len(self.content), self.chunk_size):
+            yield self.content[start : start + self.chunk_size]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 100, 10 ** 6])
+def test_get_sample_rows_for_study_streamed(
+    monkeypatch, sample_elements, chunk_size
+):
+    with open("test_data/test_xml.xml", "rb") as f:
+        content = f.read()
+    monkeypatch.setattr(
+        dbgap_extract.SESSION,
+        "get",
+        lambda *args, **kwargs: _StreamedResponse(content, chunk_size),
+    )
+    study_accession, sample_rows = dbgap_extract.get_sample_rows_for_study(
+        "phs001234.v3.p1", argparse.Namespace(expand_sra_details=False)
+    )
+    assert study_accession == "phs001234.v3.p1"
+    assert sample_rows == [
+        dbgap_extract.get_sample_row_from_xml_sample(
+            STUDY,
+            sample,
+            dbgap_extract._get_flattened_sra_data_details_from_xml_sample,
+        )
+        for sample in sample_elements
+    ]
+
+
+def test_get_sample_rows_for_study_sample_before_study(monkeypatch):
+    content = (
+        b'<DbGap><Sample submitted_sample_id="NWD1"/>'
+        b'<Study accession="phs001234.v3.p1"/></DbGap>'
+    )
+    monkeypatch.setattr(
+        dbgap_extract.SESSION,
+        "get",
+        lambda *args, **kwargs: _StreamedResponse(content, 100),
+    )
+    with pytest.raises(ValueError):
+        dbgap_extract.get_sample_rows_for_study(
+            "phs001234.v3.p1", argparse.Namespace(expand_sra_details=False)
+        )
+
+
+def test_get_sample_rows_for_study_stopped(monkeypatch):
+    with open("test_data/test_xml.xml", "rb") as f:
+        content = f.read()
+    monkeypatch.setattr(
+        dbgap_extract.SESSION,
+        "get",
+        lambda *args, **kwargs: _StreamedResponse(content, 100),
+    )
+    stop_downloads = threading.Event()
+    stop_downloads.set()
+    with pytest.raises(RuntimeError):
+        dbgap_extract.get_sample_rows_for_study(
+            "phs001234.v3.p1",
+            argparse.Namespace(expand_sra_details=False),
+            stop_downloads,
+        )
+
+
+def test_get_sample_rows_for_study_bad_sample(monkeypatch, caplog):
+    with open("test_data/test_xml.xml", "rb") as f:
+        content = f.read()
+    monkeypatch.setattr(
+        dbgap_extract.SESSION,
+        "get",
+        lambda *args, **kwargs: _StreamedResponse(content, 100),
+    )
+
+    def get_sra_data_details(sample):
+        raise KeyError("size_Gb")
+
+    monkeypatch.setattr(
+        dbgap_extract,
+        "_get_sra_data_details_function",
+        lambda args: get_sra_data_details,
+    )
+    with pytest.raises(KeyError):
+        dbgap_extract.get_sample_rows_for_study(
+            "phs001234.v3.p1", argparse.Namespace(expand_sra_details=False)
+        )
+    assert "Failed to build row for sample NWD1 of study phs001234.v3.p1" in (
+        caplog.text
+    )
+
+
+def test_write_list_of_rows_to_tsv():
+    out_file = io.StringIO()
+    tsv_writer = csv.writer(out_file, delimiter="\t")
+    dbgap_extract.write_list_of_rows_to_tsv(
+        [["NWD1", json.dumps(["Seq_DNA_SNP_CNV", "WGS"])]], tsv_writer
+    )
+    assert out_file.getvalue() == 'NWD1\t"[""Seq_DNA_SNP_CNV"", ""WGS""]"\r\n'
+
+
+def _read_extract(output_filename):
+    with open(output_filename, newline="") as f:
+        return list(csv.reader(f, delimiter="\t"))
+
+
+def test_scrape_writes_studies_in_input_order(tmp_path, monkeypatch):
+    phs2_done = threading.Event()
+
+    def get_sample_rows_for_study(study_accession, args, stop_downloads=None):
+        if study_accession == "phs000001.v1.p1":
+            # Finish after phs000002 so its rows have to be held back
+            assert phs2_done.wait(timeout=10)
+        elif study_accession == "phs000002.v1.p1":
+            phs2_done.set()
+        return study_accession, [[study_accession]]
+
+    monkeypatch.setattr(
+        dbgap_extract, "get_sample_rows_for_study", get_sample_rows_for_study
+    )
+    output_filename = str(tmp_path / "extract.tsv")
+    dbgap_extract.scrape(
+        ["phs000001.v1.p1", "phs000002.v1.p1", "phs000003.v1.p1"],
+        output_filename,
+        argparse.Namespace(expand_sra_details=False),
+    )
+    assert _read_extract(output_filename) == [
+        dbgap_extract.FIELD_NAMES,
+        ["phs000001.v1.p1"],
+        ["phs000002.v1.p1"],
+        ["phs000003.v1.p1"],
+    ]
+
+
+def _completed_future(result=None, exception=None):
+    future = Future()
+    if exception is not None:
+        future.set_exception(exception)
+    else:
+        future.set_result(result)
+    return future
+
+
+def test_pick_probe_result():
+    probe_group = ["phs000001.v4.p1", "phs000001.v3.p1"]
+    v4_empty = _completed_future(("phs000001.v4.p1", []))
+    v3_samples = _completed_future(("phs000001.v3.p1", [["NWD1"]]))
+    v3_empty = _completed_future(("phs000001.v3.p1", []))
+    failed = _completed_future(exception=ValueError("bad response"))
+
+    # v3 came back first, but v4 could still have samples
+    assert (
+        dbgap_extract._pick_probe_result(
+            probe_group, {"phs000001.v3.p1": v3_samples}
+        )
+        is None
+    )
+    assert dbgap_extract._pick_probe_result(
+        probe_group, {"phs000001.v4.p1": v4_empty, "phs000001.v3.p1": v3_samples}
+    ) == ("phs000001.v3.p1", [["NWD1"]])
+    # v4 has samples, so v3 is not needed, whether outstanding or failed
+    v4_samples = _completed_future(("phs000001.v4.p1", [["NWD1"]]))
+    assert dbgap_extract._pick_probe_result(
+        probe_group, {"phs000001.v4.p1": v4_samples}
+    ) == ("phs000001.v4.p1", [["NWD1"]])
+    assert dbgap_extract._pick_probe_result(
+        probe_group, {"phs000001.v4.p1": v4_samples, "phs000001.v3.p1": failed}
+    ) == ("phs000001.v4.p1", [["NWD1"]])
+    assert dbgap_extract._pick_probe_result(
+        probe_group, {"phs000001.v4.p1": v4_empty, "phs000001.v3.p1": v3_empty}
+    ) == ("phs000001.v3.p1", [])
+    with pytest.raises(ValueError):
+        dbgap_extract._pick_probe_result(
+            probe_group, {"phs000001.v4.p1": failed, "phs000001.v3.p1": v3_samples}
+        )
+
+
+def _stub_get_sample_rows_for_study(monkeypatch, responses):
+    """
+    Replace get_sample_rows_for_study with one returning a single row naming
+    the study for the accessions in `responses` mapped to True, no rows for
+    those mapped to False and raising for those mapped to an exception.
+    Returns the list of study accessions requested.
+    """
+    requested = []
+
+    def get_sample_rows_for_study(study_accession, args, stop_downloads=None):
+        requested.append(study_accession)
+        response = responses[study_accession]
+        if callable(response):
+            response = response()
+        if isinstance(response, Exception):
+            raise response
+        return study_accession, [[study_accession]] if response else []
+
+    monkeypatch.setattr(
+        dbgap_extract, "get_sample_rows_for_study", get_sample_rows_for_study
+    )
+    return requested
+
+
+def test_scrape_goes_back_to_previous_versions(tmp_path, monkeypatch):
+    v3_done = threading.Event()
+
+    def v3_response():
+        v3_done.set()
+        return True
+
+    def v4_response():
+        # Come back after v3, which has to wait until v4 turns out empty
+        assert v3_done.wait(timeout=10)
+        return False
+
+    requested = _stub_get_sample_rows_for_study(
+        monkeypatch,
+        {
+            "phs000001.v5.p1": False,
+            "phs000001.v4.p1": v4_response,
+            "phs000001.v3.p1": v3_response,
+        },
+    )
+    output_filename = str(tmp_path / "extract.tsv")
+    dbgap_extract.scrape(
+        ["phs000001.v5.p1"],
+        output_filename,
+        argparse.Namespace(expand_sra_details=False),
+    )
+    assert _read_extract(output_filename) == [
+        dbgap_extract.FIELD_NAMES,
+        ["phs000001.v3.p1"],
+    ]
+    assert sorted(requested) == [
+        "phs000001.v3.p1",
+        "phs000001.v4.p1",
+        "phs000001.v5.p1",
+    ]
+
+
+def test_scrape_ignores_failure_of_unneeded_version(tmp_path, monkeypatch):
+    _stub_get_sample_rows_for_study(
+        monkeypatch,
+        {
+            "phs000001.v5.p1": False,
+            "phs000001.v4.p1": True,
+            "phs000001.v3.p1": ValueError("bad response"),
+        },
+    )
+    output_filename = str(tmp_path / "extract.tsv")
+    dbgap_extract.scrape(
+        ["phs000001.v5.p1"],
+        output_filename,
+        argparse.Namespace(expand_sra_details=False),
+    )
+    assert _read_extract(output_filename) == [
+        dbgap_extract.FIELD_NAMES,
+        ["phs000001.v4.p1"],
+    ]
+
+
+def test_scrape_stops_at_already_requested_version(tmp_path, monkeypatch):
+    requested = _stub_get_sample_rows_for_study(
+        monkeypatch,
+        {
+            "phs000001.v4.p1": False,
+            "phs000001.v3.p1": False,
+            "phs000001.v2.p1": True,
+        },
+    )
+    output_filename = str(tmp_path / "extract.tsv")
+    dbgap_extract.scrape(
+        ["phs000001.v4.p1", "phs000001.v2.p1"],
+        output_filename,
+        argparse.Namespace(expand_sra_details=False),
+    )
+    # v4 goes back to v3 only, as v2 was requested for its own input line, and
+    # v3 then has nowhere left to go back to; v2's samples are written once
+    assert _read_extract(output_filename) == [
+        dbgap_extract.FIELD_NAMES,
+        ["phs000001.v2.p1"],
+    ]
+    assert sorted(requested) == [
+        "phs000001.v2.p1",
+        "phs000001.v3.p1",
+        "phs000001.v4.p1",
+    ]
+
+
+def test_scrape_requests_previous_version_before_queued_studies(
+    tmp_path, monkeypatch
+):
+    # One request at a time, so requests go out in queue order
+    monkeypatch.setattr(dbgap_extract, "MAX_CONCURRENT_REQUESTS", 1)
+    requested = _stub_get_sample_rows_for_study(
+        monkeypatch,
+        {
+            "phs000001.v2.p1": False,
+            "phs000001.v1.p1": True,
+            "phs000002.v1.p1": True,
+            "phs000003.v1.p1": True,
+        },
+    )
+    output_filename = str(tmp_path / "extract.tsv")
+    dbgap_extract.scrape(
+        ["phs000001.v2.p1", "phs000002.v1.p1", "phs000003.v1.p1"],
+        output_filename,
+        argparse.Namespace(expand_sra_details=False),
+    )
+    assert requested == [
+        "phs000001.v2.p1",
+        "phs000001.v1.p1",
+        "phs000002.v1.p1",
+        "phs000003.v1.p1",
+    ]
+
+
+def test_iter_sample_rows_for_studies_bounds_studies_held(monkeypatch):
+    monkeypatch.setattr(dbgap_extract, "MAX_CONCURRENT_REQUESTS", 4)
+    studies_to_scrape = ["phs000000.v2.p1"] + [
+        "phs{:06d}.v1.p1".format(number) for number in range(1, 41)
+    ]
+    slots = {
+        study_accession: slot for slot, study_accession in enumerate(studies_to_scrape)
+    }
+    yielded = []
+    beyond_window = []
+    v1_may_finish = threading.Event()
+
+    def v1_response():
+        # Hold up the first study; stop early if requests run past the window
+        v1_may_finish.wait(timeout=0.2)
+        return True
+
+    def response(study_accession):
+        def get_response():
+            if slots[study_accession] >= len(yielded) + 4:
+                beyond_window.append(study_accession)
+                v1_may_finish.set()
+            return True
+
+        return get_response
+
+    responses = {
+        study_accession: response(study_accession)
+        for study_accession in studies_to_scrape[1:]
+    }
+    responses["phs000000.v2.p1"] = False
+    responses["phs000000.v1.p1"] = v1_response
+    _stub_get_sample_rows_for_study(monkeypatch, responses)
+
+    study_results = dbgap_extract._iter_sample_rows_for_studies(
+        studies_to_scrape, argparse.Namespace(expand_sra_details=False)
+    )
+    for study_accession, sample_rows in study_results:
+        yielded.append(study_accession)
+    assert beyond_window == []
+    assert yielded == ["phs000000.v1.p1"] + studies_to_scrape[1:]
+
+
+def test_scrape_does_not_wait_for_downloads_after_failure(tmp_path, monkeypatch):
+    phs2_started = threading.Event()
+    phs2_stopped = threading.Event()
+
+    def get_sample_rows_for_study(study_accession, args, stop_downloads=None):
+        if study_accession == "phs000001.v1.p1":
+            assert phs2_started.wait(timeout=10)
+            raise ValueError("bad response")
+        phs2_started.set()
+        # A download that would otherwise outlast the test
+        if stop_downloads.wait(timeout=10):
+            phs2_stopped.set()
+        return study_accession, [[study_accession]]
+
+    monkeypatch.setattr(
+        dbgap_extract, "get_sample_rows_for_study", get_sample_rows_for_study
+    )
+    with pytest.raises(SystemExit):
+        dbgap_extract.scrape(
+            ["phs000001.v1.p1", "phs000002.v1.p1"],
+            str(tmp_path / "extract.tsv"),
+            argparse.Namespace(expand_sra_details=False),
+        )
+    assert phs2_stopped.wait(timeout=1)
+
+
+def test_get_unique_accessions_from_input_PHS_list(tmp_path):
+    phs_list = tmp_path / "phs_list.txt"
+    phs_list.write_text("phs000002.v1.p1\nphs000001.v2.p1\n\nphs000002.v1.p1\n")
+    accessions = validate_extract.get_unique_accessions_from_input_PHS_list(
+        str(phs_list)
+    )
+    assert accessions == ["phs000001.v2.p1", "phs000002.v1.p1"]
+
+
+def test_get_unique_accessions_from_output_extract(tmp_path):
+    extract = tmp_path / "extract.tsv"
+    extract.write_text(
+        "submitted_sample_id\tstudy_subject_id\r\n"
+        "NWD1\tphs000002.v1_ABC\r\n"
+        "NWD2\tphs000001.v2_CDE\r\n"
+        "NWD3\tphs000002.v1_FGH\r\n"
+    )
+    accessions = validate_extract.get_unique_accessions_from_output_extract(
+        str(extract)
+    )
+    assert accessions == ["phs000001", "phs000002"]
@@ -3,37 +3,19 @@ import sys
 
 
 def get_unique_accessions_from_input_PHS_list(filename):
-    f = open(filename)
-    r = f.readlines()
-    f.close()
-
-    deduped_accessions = {}
-
-    for accession in r:
-        deduped_accessions[accession.strip()] = 1
-
-    sorted_unique_accessions = list(deduped_accessions.keys())
-    sorted_unique_accessions.sort()
-    return sorted_unique_accessions
+    with open(filename) as f:
+        return sorted({line.strip() for line in f if line.strip()})
 
 
 def get_unique_accessions_from_output_extract(filename):
-    f = open(filename)
-    r = f.readlines()
-    f.close()
-
-    deduped_accessions = {}
-
-    for accession in r:
-        study = accession.split("\t")
-        accession = study[-1].strip().split(".")[0]
-        if "phs" not in accession:
-            continue
-        deduped_accessions[accession] = 1
-
-    sorted_unique_accessions = list(deduped_accessions.keys())
-    sorted_unique_accessions.sort()
-    return sorted_unique_accessions
+    deduped_accessions = set()
+    with open(filename, encoding="utf-8") as f:
+        for line in f:
+            # The study accession is the prefix of the last column, study_subject_id
+            accession = line.rpartition("\t")[2].strip().partition(".")[0]
+            if accession.startswith("phs"):
+                deduped_accessions.add(accession)
+    return sorted(deduped_accessions)
 
 
 def main():
@@ -78,8 +60,9 @@ def main():
             )
         )
 
+    output_accessions = set(accessions_from_output)
     for record in accessions_from_input:
-        if record not in accessions_from_output:
+        if record not in output_accessions:
             print(
                 "Output is missing {}. \n\t > Check if records are missing here https://www.ncbi.nlm.nih.gov/projects/gap/cgi-bin/GetSampleStatus.cgi?study_id={}&rettype=html".format(
                     record, record